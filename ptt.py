@@ -2,106 +2,132 @@ from pynput import keyboard
 import time
 import pyaudio
 import wave
-import sched
-import sys
-import os
+import threading
+import queue
+from concurrent.futures import ThreadPoolExecutor
+from transcribe_custom import transcribe_stream
 
-CHUNK = 8192
+# 16 kHz LINEAR16 is all the recognizer needs; 100 ms chunks suit streaming
+CHUNK = 1600
 FORMAT = pyaudio.paInt16
 CHANNELS = 1
-RATE = 44100
+RATE = 16000
 
 p = pyaudio.PyAudio()
-frames = []
+SAMPWIDTH = p.get_sample_size(FORMAT)
+stream = None
+audio_queue = None
+filename = None
+stop_event = threading.Event()
+
+# Transcription runs in the background so recording is never blocked.
+_pool = ThreadPoolExecutor(max_workers=2)
+pending = []
+
+
+def transcribe(frames_queue, audio_file_name):
+    try:
+        transcribe_stream(frames_queue, RATE, CHANNELS, 1, audio_file_name)
+    except Exception as e:
+        print("Transcription failed: %s\n" % e)
 
 
 def callback(in_data, frame_count, time_info, status):
-    frames.append(in_data)
+    listener.wf.writeframesraw(in_data)
+    audio_queue.put(in_data)
     return (in_data, pyaudio.paContinue)
 
 
+def print_instructions():
+    print("Press and hold the 'r' key to begin recording")
+    print("Release the 'r' key to end recording")
+    print("Press the 'q' key to quit session\n")
+
+
 class MyListener(keyboard.Listener):
     def __init__(self):
         super(MyListener, self).__init__(self.on_press, self.on_release)
-        self.key_pressed = None
+        self.recording = False
         self.wf = None
-        self.ended = None
 
     def on_press(self, key):
-        if key.char == 'r':
-            self.key_pressed = True
-        elif key.char == 'q':
-            self.ended = True
+        # Special keys such as shift have no char
+        char = getattr(key, 'char', None)
+        if char == 'r':
+            # Holding the key repeats the press event, so only start once
+            if not self.recording:
+                _start_recording()
+        elif char == 'q':
+            stop_event.set()
         return True
 
     def on_release(self, key):
-        if key.char == 'r':
-            self.key_pressed = False
+        if getattr(key, 'char', None) == 'r' and self.recording:
+            _stop_recording()
         return True
 
-    def write_file(self, frames):
-        # Create and write to audio file named with current timestamp
+    def open_file(self):
+        # Create audio file named with current timestamp; frames are
+        # written to it from the stream callback as they are recorded
         filename = time.strftime("%Y%m%d-%H%M%S.wav")
         self.wf = wave.open(filename, 'wb')
         self.wf.setnchannels(CHANNELS)
-        self.wf.setsampwidth(p.get_sample_size(FORMAT))
+        self.wf.setsampwidth(SAMPWIDTH)
         self.wf.setframerate(RATE)
-        self.wf.writeframes(b''.join(frames))
-        self.wf.close()
         return filename
 
+    def close_file(self):
+        self.wf.close()
+        self.wf = None
+
 
-def recorder():
-    global started, p, stream, frames, recording
-
-    if listener.key_pressed and not recording:
-        # Start the recording
-        try:
-            stream = p.open(format=FORMAT,
-                             channels=CHANNELS,
-                             rate=RATE,
-                             input=True,
-                             frames_per_buffer=CHUNK,
-                             stream_callback = callback)
-            recording = True
-            print("Started recording")
-        except:
-            raise
-
-    elif not listener.key_pressed and recording:
-        print("Stopped recording")
-        recording = False
-        stream.stop_stream()
-        filename = listener.write_file(frames)
-        print("Recording saved to %s\n" % filename)
-        os.system('python transcribe_custom.py {} -s 1'.format(filename))
-        frames = []     # Reset frames
-        print("Press and hold the 'r' key to begin recording")
-        print("Release the 'r' key to end recording")
-        print("Press the 'q' key to quit session\n")
-
-    elif not listener.key_pressed and listener.ended:
-        # Quit the session
-        stream.close()
-        p.terminate()
-        print("Quitting session")
-        sys.exit()
-
-    # Reschedule the recorder function in 100 ms.
-    task.enter(0.1, 1, recorder, ())
+def _start_recording():
+    global pending, audio_queue, filename
 
+    # Start the recording, streaming audio to the recognizer as it arrives
+    audio_queue = queue.Queue()
+    filename = listener.open_file()
+    stream.start_stream()
+    listener.recording = True
+    pending = [fut for fut in pending if not fut.done()]
+    pending.append(_pool.submit(transcribe, audio_queue, filename))
+    print("Started recording")
 
-if __name__ == "__main__":
-    listener = MyListener()
-    listener.start()
-    recording = False
-    stream = None
 
-    print("Press and hold the 'r' key to begin recording")
-    print("Release the 'r' key to end recording")
-    print("Press the 'q' key to quit session\n")
+def _stop_recording():
+    print("Stopped recording")
+    listener.recording = False
+    stream.stop_stream()
+    audio_queue.put(None)   # End of the audio stream
+    listener.close_file()
+    print("Recording saved to %s\n" % filename)
+    print_instructions()
+
 
-    task = sched.scheduler(time.time, time.sleep)
-    task.enter(0.1, 1, recorder, ())
-    task.run()
+if __name__ == "__main__":
+    # Open the stream once and only start/stop it for each recording
+    stream = p.open(format=FORMAT,
+                    channels=CHANNELS,
+                    rate=RATE,
+                    input=True,
+                    frames_per_buffer=CHUNK,
+                    stream_callback=callback,
+                    start=False)
 
+    listener = MyListener()
+    listener.start()
+    print_instructions()
+
+    # Recording is driven entirely by the key callbacks; wait for 'q'
+    stop_event.wait()
+    listener.stop()
+    if listener.recording:
+        _stop_recording()
+
+    # Quit the session once pending transcriptions have finished
+    for fut in pending:
+        fut.result()
+    _pool.shutdown()
+    stream.close()
+    p.terminate()
+    print("Quitting session")
@@ -22,49 +22,102 @@
       default speaker count of 1. (command line argument -s)
     - Add phrase hints to boost the probability that such words/phrases
       will be recognized. (command line argument --w)
+    - Several files may be given at once to transcribe them as a batch.
+    - Files longer than 55 seconds or larger than 10 MB are uploaded to a
+      GCS bucket before being recognized. (command line argument --bucket)
 
 Example usage:
     python transcribe_custom.py --help
     python transcribe_custom.py resources/multi.wav -s 2 --w runway delay
+    python transcribe_custom.py resources/atc.wav resources/podcast.wav
 """
 
 import argparse
-from pydub import AudioSegment
+import functools
 import io
 import os
 import wave
 import time
+import threading
+import uuid
 from google.cloud import speech_v1p1beta1 as speech
 
+# Shared across calls so the gRPC channel is set up only once.
+_client = None
+_client_lock = threading.Lock()
+_storage_client = None
+
+# Synchronous and inline recognition are capped at one minute of audio;
+# anything longer is uploaded and sent with long_running_recognize instead.
+SYNC_LIMIT_SECONDS = 55
+
+# Number of files whose operations are in flight at once in transcribe_batch.
+BATCH_SIZE = 5
+
+# Requests with inline audio content are limited to 10 MB and about a minute
+# of audio; larger or longer files are uploaded to GCS and referenced by URI.
+INLINE_LIMIT_BYTES = 10 * 1024 * 1024
+
+
+_parser = argparse.ArgumentParser(
+    description=__doc__,
+    formatter_class=argparse.RawDescriptionHelpFormatter)
+_parser.add_argument(
+    'path', nargs='+',
+    help='File(s) or GCS path for audio file to be recognized')
+_parser.add_argument(
+    '-s', help='Number of speakers - default set to 1 if argument not provided')
+_parser.add_argument(
+    '--w', nargs='*', help='Words to add as hints for the recognizer')
+_parser.add_argument(
+    '--bucket',
+    help='GCS bucket to upload audio files longer than 55 s or larger than '
+         '10 MB to')
+
 
 def parse_command_line():
     """Parses command line arguments."""
 
-    parser = argparse.ArgumentParser(
-        description=__doc__,
-        formatter_class=argparse.RawDescriptionHelpFormatter)
-    parser.add_argument(
-        'path', help='File or GCS path for audio file to be recognized')
-    parser.add_argument(
-        '-s', help='Number of speakers - default set to 1 if argument not provided')
-    parser.add_argument(
-        '--w', nargs='*', help='Words to add as hints for the recognizer')
-    args = parser.parse_args()
-    if args.path.startswith('gs://'):
-        transcribe_gcs(args.path)
-    else:
-        if args.s == None:
-            args.s = "1"
-        transcribe_file(args.path, args.w, int(args.s))
+    args = _parser.parse_args()
+    gcs_uris = [path for path in args.path if path.startswith('gs://')]
+    paths = [path for path in args.path if not path.startswith('gs://')]
+
+    for gcs_uri in gcs_uris:
+        transcribe_gcs(gcs_uri)
+
+    if args.s == None:
+        args.s = "1"
+    if len(paths) > 1:
+        transcribe_batch(paths, args.w, int(args.s), args.bucket)
+    elif paths:
+        transcribe_file(paths[0], args.w, int(args.s), args.bucket)
 
 
 def mp3_to_wav(audio_file_name):
     """Convert a MP3 file to a WAV file. Returns new file name if applicable."""
 
-    if audio_file_name.split('.')[1] == 'mp3':
-        sound = AudioSegment.from_mp3(audio_file_name)
-        new_audio_file_name = audio_file_name.split('.')[0] + '.wav'
-        sound.export(new_audio_file_name, format="wav")
+    root, ext = os.path.splitext(audio_file_name)
+    if ext.lower() == '.mp3':
+        new_audio_file_name = root + '.wav'
+
+        # Imported here so WAV-only use, such as recording, doesn't need PyAV
+        import av
+
+        # Decode in-process with libav and write 16-bit PCM frames directly
+        with av.open(audio_file_name) as container, \
+                wave.open(new_audio_file_name, 'wb') as wave_file:
+            stream = container.streams.audio[0]
+            resampler = av.AudioResampler(
+                format='s16', layout=stream.layout.name, rate=stream.rate)
+            wave_file.setnchannels(stream.channels)
+            wave_file.setsampwidth(2)
+            wave_file.setframerate(stream.rate)
+
+            for frame in container.decode(stream):
+                for pcm in resampler.resample(frame):
+                    wave_file.writeframes(pcm.to_ndarray().tobytes())
+            for pcm in resampler.resample(None):
+                wave_file.writeframes(pcm.to_ndarray().tobytes())
 
     else:
         new_audio_file_name = audio_file_name
@@ -72,129 +125,314 @@ def mp3_to_wav(audio_file_name):
     return new_audio_file_name
 
 
-def get_frame_rate_channel(audio_file_name):
-    """Gets the frame rate and number of channels."""
+def read_audio(audio_file_name):
+    """Gets the frame rate, number of channels, duration in seconds and raw
+    PCM data of a WAV file. The data is None if the audio is too long or
+    large to send inline."""
 
+    size = os.path.getsize(audio_file_name)
     with wave.open(audio_file_name, "rb") as wave_file:
         frame_rate = wave_file.getframerate()
         channels = wave_file.getnchannels()
+        nframes = wave_file.getnframes()
+        duration = nframes / frame_rate
 
-    return frame_rate, channels
-
-
-def trim_audio(audio_file_name):
-    """Trims audio to 59 seconds."""
+        if duration > SYNC_LIMIT_SECONDS or size > INLINE_LIMIT_BYTES:
+            content = None
+        else:
+            content = wave_file.readframes(nframes)
 
-    sound = AudioSegment.from_file(audio_file_name, format="wav")
-    if len(sound) > 59000:
-        new_sound = sound[:59000]
-        new_sound.export(audio_file_name, format="wav")
+    return frame_rate, channels, duration, content
 
 
-def write_file(transcript):
-    """Writes a transcript to a file named with the timestamp."""
+def write_file(transcript, filename=None):
+    """Writes a transcript to a file, named with the timestamp by default."""
 
-    filename = time.strftime("%Y%m%d-%H%M%S.txt")
-    f = open(filename, "w+")
-    f.write(transcript)
+    if filename is None:
+        filename = time.strftime("%Y%m%d-%H%M%S.txt")
+    with open(filename, "w", encoding="utf-8", buffering=65536) as f:
+        f.write(transcript)
     print("Transcript saved to %s\n" % filename)
-    f.close()
 
 
 def write_vocab(words, filename):
     """Writes new vocabulary to an existing vocabulary file."""
 
-    write_str = ""
-    for i in words:
-        write_str += "%s\n" % i
-
-    f = open(filename, "w")
-    f.write(write_str)
-    f.close()
+    with open(filename, "w", encoding="utf-8") as f:
+        f.write("\n".join(words) + "\n")
 
 
 def load_vocab(filename):
     """Returns the vocabulary file in the form of a list."""
 
-    f = open(filename, "r")
-    words = f.read().split('\n')
-    words = list(filter(None, words))
-    f.close()
-    return words
+    with open(filename, "r", encoding="utf-8") as f:
+        return [word for word in f.read().splitlines() if word]
 
 
-def transcribe_file(speech_file, hints, speakers):
-    """Transcribe the given audio file synchronously."""
+def _get_client():
+    """Returns the shared SpeechClient, creating it on first use."""
 
-    AudioSegment.converter = "C:\\ffmpeg\\bin\\ffmpeg.exe"  # Set to location of ffmpeg.exe
-    speech_file = mp3_to_wav(speech_file)
-    frame_rate, channels = get_frame_rate_channel(speech_file)
-    trim_audio(speech_file)
-
-    client = speech.SpeechClient()
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = speech.SpeechClient()
+    return _client
 
-    with open(speech_file, 'rb') as audio_file:
-        content = audio_file.read()
 
-    audio = speech.types.RecognitionAudio(content=content)
+@functools.lru_cache(maxsize=32)
+def build_config(frame_rate, channels, speakers, words):
+    """Builds the recognition config for the given audio and vocabulary.
+    Configs are cached, so words must be a tuple and the returned config
+    must not be modified."""
 
-    # Load and add vocabulary hints
-    words = load_vocab("vocab.txt")
-    words_set = set(words)
-    if hints is not None:
-        for i in hints:
-            if i not in words_set:
-                words.append(i)
-        write_vocab(words, "vocab.txt")
-
-    config = speech.types.RecognitionConfig(
+    return speech.types.RecognitionConfig(
         encoding=speech.enums.RecognitionConfig.AudioEncoding.LINEAR16,
         sample_rate_hertz=frame_rate,
         language_code='en-US',
         audio_channel_count=channels,
-        enable_separate_recognition_per_channel=True,
+        # Per-channel recognition only makes sense with more than one channel
+        enable_separate_recognition_per_channel=channels > 1,
         enable_speaker_diarization=True,
         diarization_speaker_count=speakers,
         enable_automatic_punctuation=True,
-        speech_contexts=[{"phrases": words}])
+        speech_contexts=[{"phrases": list(words)}])
 
-    print('Waiting for operation to complete...\n')
-    response = client.recognize(config, audio)
-
-    # The transcript within each result is separate and sequential per result.
-    # However, the words list within an alternative includes all the words
-    # from all the results thus far. Thus, to get all the words with speaker
-    # tags, you only have to take the words list from the last result:
 
-    result = response.results[-1]
-    words_info = result.alternatives[0].words
+def format_transcript(words_info):
+    """Returns the recognized words as one line per speaker turn."""
 
-    transcript = ""
+    lines = []
     tag = 1
-    speaker = ""
+    speaker = []
 
-    # Printing out the output:
     for word_info in words_info:
         if word_info.speaker_tag == tag:
-            speaker = speaker + " " + word_info.word
+            speaker.append(word_info.word)
         else:
-            transcript += "Speaker {}: {}".format(tag, speaker) + '\n'
+            lines.append("Speaker {}: {}".format(tag, " ".join(speaker)))
             tag = word_info.speaker_tag
-            speaker = "" + word_info.word
+            speaker = [word_info.word]
+
+    lines.append("Speaker {}: {}".format(tag, " ".join(speaker)))
+
+    return "\n".join(lines) + "\n"
+
+
+def update_vocab(hints):
+    """Adds new hints to the vocabulary file and returns all the words."""
+
+    words = load_vocab("vocab.txt")
+    words_set = set(words)
+    added = [i for i in dict.fromkeys(hints or []) if i not in words_set]
+    if added:
+        words.extend(added)
+        write_vocab(words, "vocab.txt")
+
+    return words
+
+
+def _get_storage_client():
+    """Returns the shared GCS client, creating it on first use."""
+
+    # Imported here so recording without uploads doesn't need the package
+    from google.cloud import storage
+
+    global _storage_client
+    with _client_lock:
+        if _storage_client is None:
+            _storage_client = storage.Client()
+    return _storage_client
+
+
+def upload_gcs(audio_file_name, bucket_name):
+    """Uploads a file to a GCS bucket. Returns the GCS URI of the file."""
+
+    # Unique names keep files with the same base name in one batch apart
+    blob_name = "{}-{}".format(
+        uuid.uuid4().hex, os.path.basename(audio_file_name))
+    blob = _get_storage_client().bucket(bucket_name).blob(blob_name)
+    blob.upload_from_filename(audio_file_name)
+
+    return "gs://{}/{}".format(bucket_name, blob_name)
 
-    transcript += "Speaker {}: {}".format(tag, speaker)
-    transcript += "\n"
 
+def delete_gcs(gcs_uri):
+    """Deletes a file uploaded by upload_gcs."""
+
+    bucket_name, blob_name = gcs_uri[len("gs://"):].split("/", 1)
+    try:
+        _get_storage_client().bucket(bucket_name).blob(blob_name).delete()
+    except Exception as e:
+        print("Could not delete %s: %s\n" % (gcs_uri, e))
+
+
+def load_audio(speech_file, bucket=None):
+    """Gets the frame rate, number of channels, duration and recognition
+    audio of a MP3/WAV file."""
+
+    speech_file = mp3_to_wav(speech_file)
+    frame_rate, channels, duration, content = read_audio(speech_file)
+
+    if content is None:
+        # Too long or large to send inline, so upload it instead
+        if bucket is None:
+            raise ValueError(
+                "{} is too long or large to send inline; use --bucket to "
+                "upload it to GCS".format(speech_file))
+        uri = upload_gcs(speech_file, bucket)
+        audio = speech.types.RecognitionAudio(uri=uri)
+    else:
+        # LINEAR16 accepts headerless PCM since the sample rate is in the config
+        audio = speech.types.RecognitionAudio(content=content)
+
+    return frame_rate, channels, duration, audio
+
+
+def results_words(results):
+    """Returns the words from all the results, each word only once."""
+
+    # With diarization the last result may repeat the words of the earlier
+    # results with their speaker tags, so words are keyed by channel and start
+    # time and later occurrences replace earlier ones. Words of separately
+    # recognized channels are then merged in time order.
+    words_info = {}
+    for result in results:
+        if not result.alternatives:
+            continue
+        for word_info in result.alternatives[0].words:
+            start = word_info.start_time
+            key = (result.channel_tag, start.seconds, start.nanos,
+                   word_info.word)
+            words_info[key] = word_info
+
+    return sorted(words_info.values(),
+                  key=lambda w: (w.start_time.seconds, w.start_time.nanos))
+
+
+def transcribe_file(speech_file, hints, speakers, bucket=None):
+    """Transcribe the given audio file."""
+
+    frame_rate, channels, duration, audio = load_audio(speech_file, bucket)
+    try:
+        words = tuple(update_vocab(hints))
+        config = build_config(frame_rate, channels, speakers, words)
+
+        client = _get_client()
+        print('Waiting for operation to complete...\n')
+        # load_audio only leaves audio inline when it is short enough to
+        # recognize synchronously; uploaded audio goes through
+        # long_running_recognize
+        if audio.uri:
+            operation = client.long_running_recognize(config, audio)
+            response = operation.result(timeout=max(90, 2 * duration))
+        else:
+            response = client.recognize(config, audio)
+    finally:
+        if audio.uri:
+            delete_gcs(audio.uri)
+
+    words_info = results_words(response.results)
+    if not words_info:
+        print("No speech recognized\n")
+        return
+
+    transcript = format_transcript(words_info)
     print(transcript)
     write_file(transcript)  # Write to timestamped file
 
 
+def transcribe_batch(speech_files, hints, speakers, bucket=None):
+    """Transcribe several audio files, keeping up to BATCH_SIZE operations
+    in flight at once. Each transcript is written next to its audio file."""
+
+    words = tuple(update_vocab(hints))
+    client = _get_client()
+
+    for i in range(0, len(speech_files), BATCH_SIZE):
+        # A failing file is reported and skipped so the rest of the batch
+        # is still transcribed
+        operations = []
+        for speech_file in speech_files[i:i + BATCH_SIZE]:
+            audio = None
+            try:
+                frame_rate, channels, duration, audio = load_audio(
+                    speech_file, bucket)
+                config = build_config(frame_rate, channels, speakers, words)
+                operation = client.long_running_recognize(config, audio)
+            except Exception as e:
+                print("Transcription of %s failed: %s\n" % (speech_file, e))
+                if audio is not None and audio.uri:
+                    delete_gcs(audio.uri)
+                continue
+            operations.append((speech_file, duration, audio, operation))
+
+        print('Waiting for %d operations to complete...\n' % len(operations))
+        for speech_file, duration, audio, operation in operations:
+            try:
+                response = operation.result(timeout=max(90, 2 * duration))
+            except Exception as e:
+                print("Transcription of %s failed: %s\n" % (speech_file, e))
+                continue
+            finally:
+                if audio.uri:
+                    delete_gcs(audio.uri)
+            words_info = results_words(response.results)
+            if not words_info:
+                print("No speech recognized in %s\n" % speech_file)
+                continue
+
+            transcript = format_transcript(words_info)
+            print("%s:\n%s" % (speech_file, transcript))
+            write_file(transcript, os.path.splitext(speech_file)[0] + ".txt")
+
+
+def stream_requests(frames_queue):
+    """Yields audio chunks from the queue until None is received."""
+
+    while True:
+        chunk = frames_queue.get()
+        if chunk is None:
+            return
+        yield speech.types.StreamingRecognizeRequest(audio_content=chunk)
+
+
+def transcribe_stream(frames_queue, frame_rate, channels, speakers,
+                      audio_file_name=None):
+    """Transcribe raw LINEAR16 audio chunks from a queue as they arrive.
+    The transcript is written next to audio_file_name if it is given."""
+
+    words = tuple(load_vocab("vocab.txt"))
+    config = build_config(frame_rate, channels, speakers, words)
+    streaming_config = speech.types.StreamingRecognitionConfig(config=config)
+
+    responses = _get_client().streaming_recognize(
+        streaming_config, stream_requests(frames_queue))
+
+    final_results = []
+    for response in responses:
+        for result in response.results:
+            if result.is_final:
+                final_results.append(result)
+
+    # A short tap or a recording without speech gives no words to save
+    words_info = results_words(final_results)
+    if not words_info:
+        print("No speech recognized\n")
+        return
+
+    transcript = format_transcript(words_info)
+    print(transcript)
+    if audio_file_name is None:
+        write_file(transcript)  # Write to timestamped file
+    else:
+        write_file(transcript, os.path.splitext(audio_file_name)[0] + ".txt")
+
+
 ############ FOR FUTURE DEVELOPMENT WITH FILES STORED ON GOOGLE CLOUD ############
 def transcribe_gcs(gcs_uri):
     """Transcribe the given audio file on GCS."""
     # [START speech_transcribe_multichannel_gcs]
-    from google.cloud import speech
-    client = speech.SpeechClient()
+    client = _get_client()
 
     audio = speech.types.RecognitionAudio(uri=gcs_uri)
 